@@ -7,27 +7,37 @@ Versione: 6.0  (private-first + org auth + manual approval + totals)
 
 import os
 import re
+import html
+import time
+import asyncio
 import sqlite3
 import shutil
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from pathlib import Path
 from glob import glob
+from collections import OrderedDict
+from functools import lru_cache
+from contextlib import contextmanager
+import calendar
 import zoneinfo
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, NamedTuple
 
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton, Message,
     ReplyKeyboardMarkup, KeyboardButton
 )
 from telegram.constants import ChatType
-from telegram.error import Forbidden, BadRequest
+from telegram.error import Forbidden, BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     ContextTypes, filters, CallbackQueryHandler,
     ApplicationHandlerStop
 )
+from telegram.request import HTTPXRequest
 
 # -------------------- Config --------------------
 VERSION = "ShiftBot 6.0"
@@ -35,9 +45,29 @@ TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "").strip()
 DB_PATH = os.environ.get("SHIFTBOT_DB", "shiftbot.sqlite3")
 LOG_PATH = os.environ.get("SHIFTBOT_LOG", "logs/shiftbot.log")
 
+DB_POOL_SIZE = int(os.environ.get("SHIFTBOT_DB_POOL_SIZE", "8"))  # connessioni SQLite riusate
+# I/O SQLite per connessione: pagine lette da memoria mappata + page cache (limiti massimi, non allocati subito)
+DB_MMAP_BYTES = int(os.environ.get("SHIFTBOT_DB_MMAP_BYTES", str(256 * 1024 * 1024)))
+DB_CACHE_KB = int(os.environ.get("SHIFTBOT_DB_CACHE_KB", str(64 * 1024)))
+
 BACKUP_DIR = os.environ.get("SHIFTBOT_BACKUP_DIR", "backups")
 BACKUP_KEEP = int(os.environ.get("SHIFTBOT_BACKUP_KEEP", "14"))  # numero backup da mantenere
 
+# update processati in parallelo (il bot è network-bound: mentre uno attende Telegram, gli altri avanzano)
+CONCURRENT_UPDATES = int(os.environ.get("SHIFTBOT_CONCURRENT_UPDATES", "32"))
+# pool HTTP verso api.telegram.org: una connessione per update concorrente; in picco si attende (timeout) invece di fallire
+HTTP_POOL_SIZE = int(os.environ.get("SHIFTBOT_HTTP_POOL_SIZE", str(CONCURRENT_UPDATES)))
+HTTP_POOL_TIMEOUT = float(os.environ.get("SHIFTBOT_HTTP_POOL_TIMEOUT", "30"))
+# HTTP/2 solo se il pacchetto h2 è installato (httpx[http2]); altrimenti HTTP/1.1 keep-alive
+try:
+    import h2  # noqa: F401
+    _HTTP_VERSION_DEFAULT = "2"
+except ImportError:
+    _HTTP_VERSION_DEFAULT = "1.1"
+HTTP_VERSION = os.environ.get("SHIFTBOT_HTTP_VERSION", _HTTP_VERSION_DEFAULT)
+# long polling: getUpdates resta appeso lato server fino a N secondi (meno round-trip a vuoto)
+POLL_TIMEOUT = int(os.environ.get("SHIFTBOT_POLL_TIMEOUT", "25"))
+
 TZ = zoneinfo.ZoneInfo("Europe/Rome")
 
 # -------------------- Logging --------------------
@@ -50,13 +80,14 @@ if not logger.handlers:
     Path(os.path.dirname(LOG_PATH) or ".").mkdir(parents=True, exist_ok=True)
 
     fmt = logging.Formatter("[%(asctime)s] %(levelname)s %(message)s")
+    _log_sinks = []
 
     # file log rotante
     try:
         fh = RotatingFileHandler(LOG_PATH, maxBytes=2_000_000, backupCount=5, encoding="utf-8")
         fh.setFormatter(fmt)
         fh.setLevel(logging.INFO)
-        logger.addHandler(fh)
+        _log_sinks.append(fh)
     except Exception:
         pass
 
@@ -64,7 +95,15 @@ if not logger.handlers:
     sh = logging.StreamHandler()
     sh.setFormatter(fmt)
     sh.setLevel(logging.INFO)
-    logger.addHandler(sh)
+    _log_sinks.append(sh)
+
+    # gli handler fanno solo put() su una coda; file/stdout li scrive un thread dedicato,
+    # così un flush lento non blocca mai l'event loop
+    _log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(_log_queue))
+    _log_listener = QueueListener(_log_queue, *_log_sinks, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
 
 #
 # -------------------- Logging helpers --------------------
@@ -217,23 +256,65 @@ ORG_ADMINS = {
     ORG_PDBNAFR: {666837389},  # admin PDBFRNA
 }
 
-WELCOME_TEXT = (
+# Testi statici già in HTML e composti una volta all'import (parse_mode="HTML")
+WELCOME_HTML = (
     "👋 Benvenuto/a!\n\n"
-    "Questo bot gestisce i *cambi turno*.\n\n"
-    "✅ Per usare il bot devi essere *autenticato* nel tuo reparto.\n"
+    "Questo bot gestisce i <b>cambi turno</b>.\n\n"
+    "✅ Per usare il bot devi essere <b>autenticato</b> nel tuo reparto.\n"
     "1) Scrivi /start\n"
-    "2) Inserisci il *codice reparto*\n"
+    "2) Inserisci il <b>codice reparto</b>\n"
     "3) Attendi approvazione dell’admin\n\n"
     "Poi potrai:\n"
     "• Caricare un turno (invia immagine)\n"
     "• Cercare turni\n"
     "• Vedere le date\n"
 )
+START_AUTH_HTML = (
+    WELCOME_HTML + "\n\n"
+    "📌 Inserisci il codice reparto:\n"
+    f"• <code>{ORG_PDCNAFR}</code> = {html.escape(ORG_LABELS[ORG_PDCNAFR])}\n"
+    f"• <code>{ORG_PDBNAFR}</code> = {html.escape(ORG_LABELS[ORG_PDBNAFR])}\n\n"
+    "Esempio:\n<code>/start PDCFRNA</code>"
+)
+# Esiti SETDATE: template HTML fissi, solo la data va formattata (niente escape Markdown)
+SETDATE_DUP_HTML = "⛔ Hai già un turno aperto per il {human}.\nUsa <b>I miei turni</b> per gestire."
+SETDATE_NOT_APPROVED_HTML = (
+    "⛔ Non posso registrare il turno perché non risulti più <b>approvato</b> in un reparto.\n"
+    "Rifai /start con il tuo codice reparto e riprova."
+)
+SETDATE_BAD_ORG_HTML = "⛔ Non posso registrare il turno: reparto non valido.\nRifai /start e riprova."
+
+# Motore regex per le date nelle caption: google-re2 (DFA, tempo lineare) se installato, altrimenti re
+try:
+    import re2 as _date_re
+except ImportError:
+    _date_re = re
+
+# Un'unica alternanza per GG/MM/AAAA e AAAA/MM/GG: il testo viene scandito una volta sola.
+# Bordi solo sulle cifre (lettere attaccate vanno bene: "turno14/02/2026"): il match parte a inizio
+# di un numero; prefisso consumante invece del lookbehind perché RE2 non supporta i lookaround.
+# La cifra subito dopo la data ("14/02/20261") la scarta parse_date.
+_DATE_RE = _date_re.compile(
+    r'(?:^|\D)(?:(?P<d1>\d{1,2})[\/\-\.\s](?P<m1>\d{1,2})[\/\-\.\s](?P<y1>\d{4})'
+    r'|(?P<y2>\d{4})[\/\-\.\s](?P<m2>\d{1,2})[\/\-\.\s](?P<d2>\d{1,2}))'
+)
+
+_DIGIT_RE = re.compile(r'\d')
 
-DATE_PATTERNS = [
-    r'(?P<d>\d{1,2})[\/\-\.\s](?P<m>\d{1,2})[\/\-\.\s](?P<y>\d{4})',
-    r'(?P<y>\d{4})[\/\-\.\s](?P<m>\d{1,2})[\/\-\.\s](?P<d>\d{1,2})',
-]
+# Righe del log per /stats: [2026-02-06 23:40:59,367] INFO event=tutorial user_id=...
+LOG_LINE_RE = re.compile(r"^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+\]\s+\w+\s+(.*)$")
+
+# Date ISO nei callback_data (YYYY-MM-DD): validazione leggera, senza strptime
+_ISO_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+
+# callback_data compatti del calendario: 1 lettera di modalità + YYYYMMDD
+# (es. "S20260214" = SETDATE, "NR20260301" = NAV verso marzo in modalità SEARCH)
+CAL_MODE_CODES = {"SETDATE": "S", "SEARCH": "R"}
+CAL_CODE_MODES = {v: k for k, v in CAL_MODE_CODES.items()}
+CAL_NAV_CODE = "N"
+
+# Username Telegram valido salvato come "@handle" (niente spazi/unicode: URL t.me sicuri)
+USERNAME_RE = re.compile(r'^@([A-Za-z0-9_]{3,32})$')
 
 # -------------------- UI Keyboard --------------------
 PRIVATE_KB = ReplyKeyboardMarkup(
@@ -247,8 +328,129 @@ PRIVATE_KB = ReplyKeyboardMarkup(
     input_field_placeholder="Usa i pulsanti 👇"
 )
 
+OPEN_PRIVATE_PROMPT = "Per leggere la guida devi prima aprire la chat privata con me:"
+
+# Tastiere con un solo pulsante URL: dipendono solo dai loro argomenti e sono immutabili,
+# quindi si costruiscono una volta e si riusano (niente allocazioni dopo il primo uso)
+@lru_cache(maxsize=16)
+def _deeplink_kb(bot_username: str, arg: str = "start", label: str = "🔒 Apri chat privata col bot") -> InlineKeyboardMarkup:
+    """Pulsante che apre la chat privata col bot con /start <arg>."""
+    url = f"https://t.me/{bot_username}?start={arg}"
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, url=url)]])
+
+@lru_cache(maxsize=1024)
+def _contact_url_kb(url: str) -> InlineKeyboardMarkup:
+    """Pulsante "Contatta autore" verso t.me/<handle> (stessi autori in ogni ricerca)."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("📩 Contatta autore", url=url)]])
+
+# Documenti immagine: filters.Document.IMAGE dove disponibile (probe una volta all'import)
+IMG_DOC_FILTER = (
+    filters.Document.IMAGE
+    if hasattr(filters.Document, "IMAGE")
+    else filters.Document.MimeType("image/")
+)
+
 # -------------------- Volatile state --------------------
-PENDING: Dict[int, Dict[str, Any]] = {}  # calendario -> dati post/immagine
+# calendario -> dati post/immagine. Calendari mai cliccati scadono dopo PENDING_TTL
+# e il totale è limitato a PENDING_MAX (i più vecchi escono per primi).
+PENDING_TTL = 600
+PENDING_MAX = 256
+
+class _Pending(NamedTuple):
+    """Upload in attesa della data scelta dal calendario (tupla: niente dict per voce)."""
+    src_chat_id: int
+    src_msg_id: int
+    owner_id: Optional[int]
+    owner_username: str
+    caption: str
+    file_id: Optional[str]
+    inserted_at: float  # time.monotonic() all'inserimento, per il TTL
+
+PENDING: "OrderedDict[int, _Pending]" = OrderedDict()
+
+def pending_put(cal_msg_id: int, entry: _Pending):
+    PENDING[cal_msg_id] = entry
+    PENDING.move_to_end(cal_msg_id)
+    pending_evict()
+
+def pending_pop(cal_msg_id: Optional[int]) -> Optional[_Pending]:
+    entry = PENDING.pop(cal_msg_id, None)
+    if entry and time.monotonic() - entry.inserted_at > PENDING_TTL:
+        return None
+    return entry
+
+def pending_evict():
+    """Rimuove dalla testa (inserimenti più vecchi) le voci scadute o in eccesso."""
+    cutoff = time.monotonic() - PENDING_TTL
+    while PENDING:
+        oldest = next(iter(PENDING.values()))
+        if oldest.inserted_at >= cutoff and len(PENDING) <= PENDING_MAX:
+            break
+        PENDING.popitem(last=False)
+
+async def pending_gc_job(ctx: ContextTypes.DEFAULT_TYPE):
+    # job periodico: libera anche i calendari abbandonati quando non arrivano nuovi upload
+    pending_evict()
+
+
+# -------------------- Outbound rate limit --------------------
+# Tetto globale ~30 msg/s di Telegram: limitiamo gli invii in volo e rispettiamo i FloodWait
+SEND_CONCURRENCY = int(os.environ.get("SHIFTBOT_SEND_CONCURRENCY", "25"))
+SEND_RATE = float(os.environ.get("SHIFTBOT_SEND_RATE", "25"))                     # msg/s globali
+SEND_CHAT_INTERVAL = float(os.environ.get("SHIFTBOT_SEND_CHAT_INTERVAL", "1"))    # s tra invii nella stessa chat...
+SEND_CHAT_BURST = int(os.environ.get("SHIFTBOT_SEND_CHAT_BURST", "20"))           # ...dopo i primi N immediati
+SEND_MAX_RETRIES = 3
+_send_sem = asyncio.Semaphore(SEND_CONCURRENCY)   # solo chiamate HTTP in volo: nessuno ci dorme dentro
+_send_next = 0.0      # prossimo slot globale libero (loop.time())
+_flood_until = 0.0    # dopo un RetryAfter nessuno invia prima di questo istante
+_chat_tat: dict[int, float] = {}   # per chat: istante "teorico" del prossimo invio (GCRA)
+
+async def _sleep_until(at: float):
+    delay = at - asyncio.get_running_loop().time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+async def _chat_slot(chat_id: int):
+    """Attende il turno nella chat: i primi SEND_CHAT_BURST invii partono subito, poi uno ogni SEND_CHAT_INTERVAL s.
+
+    Nessun await tra lettura e prenotazione: niente lock (un solo event loop).
+    """
+    now = asyncio.get_running_loop().time()
+    tat = max(_chat_tat.get(chat_id, now), now)
+    if len(_chat_tat) > 1024:
+        for k in [k for k, v in _chat_tat.items() if v < now]:
+            del _chat_tat[k]
+    _chat_tat[chat_id] = tat + SEND_CHAT_INTERVAL
+    await _sleep_until(tat - (SEND_CHAT_BURST - 1) * SEND_CHAT_INTERVAL)
+
+async def _global_slot():
+    """Prenota lo slot globale (SEND_RATE msg/s, pausa FloodWait) all'istante effettivo dell'invio."""
+    global _send_next
+    at = max(asyncio.get_running_loop().time(), _send_next, _flood_until)
+    _send_next = at + 1 / SEND_RATE
+    await _sleep_until(at)
+
+async def safe_send(coro_factory, chat_id=None):
+    """Esegue una chiamata ctx.bot.* (passata come lambda) rispettando il rate limit e riprovando dopo RetryAfter.
+
+    La lambda serve perché una coroutine già attesa non si può riusare al retry.
+    Le attese (per chat, globali) avvengono fuori dal semaforo: una chat in coda non blocca le altre.
+    """
+    global _flood_until
+    if chat_id is not None:
+        await _chat_slot(chat_id)
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        await _global_slot()
+        try:
+            async with _send_sem:
+                return await coro_factory()
+        except RetryAfter as e:
+            if attempt == SEND_MAX_RETRIES:
+                raise
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"[flood] RetryAfter {delay}s (tentativo {attempt + 1})")
+            # pausa globale: gli altri invii in coda non martellano l'API durante il FloodWait
+            _flood_until = max(_flood_until, asyncio.get_running_loop().time() + delay)
 
 
 # -------------------- Backup helpers --------------------
@@ -284,19 +486,23 @@ def make_db_backup(reason: str = "scheduled") -> Optional[str]:
         if not os.path.exists(DB_PATH):
             msg = f"[backup] DB non trovato, salto backup (DB_PATH={DB_PATH})"
             logger.warning(msg)
-            print(msg, flush=True)
             return None
 
-        shutil.copy2(DB_PATH, dst)
+        # API di backup SQLite: copia coerente anche con journal WAL (le pagine ancora nel -wal sono incluse)
+        src = sqlite3.connect(DB_PATH)
+        out = sqlite3.connect(dst)
+        try:
+            src.backup(out)
+        finally:
+            out.close()
+            src.close()
         _rotate_backups(BACKUP_DIR, BACKUP_KEEP)
         msg = f"[backup] OK ({reason}) -> {dst}"
         logger.info(msg)
-        print(msg, flush=True)
         return dst
     except Exception as e:
         msg = f"[backup] ERRORE ({reason}): {e}"
         logger.error(msg)
-        print(msg, flush=True)
         return None
 
 async def backup_job(ctx: ContextTypes.DEFAULT_TYPE):
@@ -307,7 +513,7 @@ async def backup_job(ctx: ContextTypes.DEFAULT_TYPE):
 # -------------------- Helpers: FS / DB --------------------
 def ensure_parent_dir(path: str):
     parent = os.path.dirname(path)
-    if parent and not os.path.exists(parent):
+    if parent:
         os.makedirs(parent, exist_ok=True)
 
 def migrate_sqlite_if_needed(persistent_path: str, legacy_path: str = "shiftbot.sqlite3"):
@@ -317,12 +523,114 @@ def migrate_sqlite_if_needed(persistent_path: str, legacy_path: str = "shiftbot.
     """
     if os.path.abspath(persistent_path) == os.path.abspath(legacy_path):
         return
-    if not os.path.exists(persistent_path) and os.path.exists(legacy_path):
+    try:
+        src = open(legacy_path, "rb")
+    except FileNotFoundError:
+        return
+    with src:
+        # "xb": crea il DB persistente solo se non esiste (controllo e creazione atomici)
         try:
-            shutil.copy2(legacy_path, persistent_path)
-            print(f"[ShiftBot] Migrato DB da {legacy_path} → {persistent_path}")
+            dst = open(persistent_path, "xb")
+        except FileExistsError:
+            return
+        except Exception as e:
+            logger.error(f"[ShiftBot] Migrazione DB fallita: {e}")
+            return
+        try:
+            with dst:
+                shutil.copyfileobj(src, dst)
+            shutil.copystat(legacy_path, persistent_path)
+            logger.info(f"[ShiftBot] Migrato DB da {legacy_path} → {persistent_path}")
         except Exception as e:
-            print(f"[ShiftBot] Migrazione DB fallita: {e}")
+            # non lasciare un DB persistente troncato: al prossimo avvio si riprova
+            try:
+                os.remove(persistent_path)
+            except OSError:
+                pass
+            logger.error(f"[ShiftBot] Migrazione DB fallita: {e}")
+
+# -------------------- DB connection pool --------------------
+_DB_POOL: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=DB_POOL_SIZE)
+
+def _db_connect() -> sqlite3.Connection:
+    """Nuova connessione long-lived per il pool (autocommit, WAL)."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=512)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=30000;")
+    # PRAGMA per-connessione: vanno impostati qui, non una volta sola in ensure_db
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES};")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB};")
+    # tabelle/indici temporanei (GROUP BY, sort) in RAM invece che su file
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    return conn
+
+def init_db_pool():
+    """Pre-riempie il pool (da chiamare dopo ensure_db)."""
+    while not _DB_POOL.full():
+        _DB_POOL.put_nowait(_db_connect())
+
+@contextmanager
+def pool_acquire():
+    """Presta una connessione del pool e la restituisce all'uscita.
+
+    Se il pool è vuoto apre una connessione extra; se al rientro è pieno la chiude.
+    """
+    try:
+        conn = _DB_POOL.get_nowait()
+    except queue.Empty:
+        conn = _db_connect()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _DB_POOL.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+async def db_fetchone(sql: str, params: tuple = ()) -> Optional[tuple]:
+    """SELECT su una connessione del pool, eseguita in un thread: l'event loop resta libero."""
+    def _run():
+        with pool_acquire() as conn:
+            return conn.execute(sql, params).fetchone()
+    return await asyncio.to_thread(_run)
+
+async def db_execute(sql: str, params: tuple = ()) -> int:
+    """INSERT/UPDATE/DELETE in un thread; ritorna il numero di righe toccate."""
+    def _run():
+        with pool_acquire() as conn:
+            return conn.execute(sql, params).rowcount
+    return await asyncio.to_thread(_run)
+
+# Query dei percorsi caldi: testo SQL unico a livello modulo, così la cache degli statement
+# preparati di ogni connessione del pool (chiave = testo SQL) va sempre a segno
+# Inserisce solo se l'utente non ha già un turno aperto per quella data: un unico statement
+# (atomico, niente SELECT separata); RETURNING id vuoto = duplicato
+_SQL_INSERT_SHIFT = """INSERT INTO shifts(chat_id, message_id, user_id, username, date_iso, date_ord, caption, photo_file_id, org, status)
+                       SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, 'open'
+                       WHERE NOT EXISTS (SELECT 1 FROM shifts WHERE user_id=? AND date_iso=? AND status='open')
+                       RETURNING id"""
+MY_SHIFTS_LIMIT = 50  # turni mostrati in "I miei turni"
+# ordinato per data turno percorrendo l'indice (user_id, date_iso, status) all'indietro, senza sort:
+# niente tie-break su id, _SQL_INSERT_SHIFT già esclude due turni aperti per utente/data
+_SQL_MY_SHIFTS = """SELECT id, chat_id, message_id, date_iso, caption, photo_file_id
+                    FROM shifts
+                    WHERE user_id=? AND status='open' AND org=?
+                    ORDER BY date_iso DESC
+                    LIMIT ?"""
+_SQL_DATE_SHIFTS = """SELECT id, chat_id, message_id, user_id, username, caption, photo_file_id
+                      FROM shifts
+                      WHERE date_iso=? AND status='open'
+                      ORDER BY created_at ASC"""
+_SQL_DATE_SHIFTS_ORG = """SELECT id, chat_id, message_id, user_id, username, caption, photo_file_id
+                          FROM shifts
+                          WHERE date_iso=? AND status='open' AND org=?
+                          ORDER BY created_at ASC"""
+_SQL_DATES_AGG = """SELECT date_iso, COUNT(*) FROM shifts
+                    WHERE status='open' AND org=?
+                    GROUP BY date_ord ORDER BY date_ord ASC"""
 
 def ensure_db():
     conn = sqlite3.connect(DB_PATH)
@@ -337,6 +645,7 @@ def ensure_db():
             user_id INTEGER,
             username TEXT,
             date_iso TEXT NOT NULL,
+            date_ord INTEGER,
             caption TEXT,
             photo_file_id TEXT,
             org TEXT,
@@ -361,12 +670,32 @@ def ensure_db():
         except Exception:
             pass
 
+    if "date_ord" not in cols:
+        try:
+            cur.execute("ALTER TABLE shifts ADD COLUMN date_ord INTEGER;")
+        except Exception:
+            pass
+
+    # Backfill: date_ord = YYYYMMDD intero (ordinamenti/confronti senza collation testo)
+    try:
+        cur.execute("UPDATE shifts SET date_ord=CAST(replace(date_iso, '-', '') AS INTEGER) WHERE date_ord IS NULL")
+    except Exception:
+        pass
+
     # Backfill: i turni storici (pre-org) li consideriamo PDC di default
     try:
         cur.execute("UPDATE shifts SET org=? WHERE org IS NULL", (ORG_PDCNAFR,))
     except Exception:
         pass
 
+    # Indici composti sui predicati caldi: utente/data/stato (controllo duplicati in insert, I miei turni)
+    # e data/stato con created_at già ordinato (Cerca, niente sort temporaneo).
+    # Sostituiscono i vecchi idx_shifts_user/idx_shifts_date, che ne sono prefissi.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_shifts_user_date_status ON shifts(user_id, date_iso, status);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_shifts_date_status_created ON shifts(date_iso, status, created_at);")
+    cur.execute("DROP INDEX IF EXISTS idx_shifts_user;")
+    cur.execute("DROP INDEX IF EXISTS idx_shifts_date;")
+
     # Nuova tabella utenti (auth per reparto)
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -401,55 +730,98 @@ def ensure_db():
         except Exception:
             pass
 
+    # Normalizza eventuali username legacy salvati come BLOB: da qui in poi sono sempre str | None
+    try:
+        cur.execute("UPDATE shifts SET username=CAST(username AS TEXT) WHERE typeof(username)='blob'")
+        cur.execute("UPDATE users SET username=CAST(username AS TEXT) WHERE typeof(username)='blob'")
+    except Exception:
+        pass
+
     conn.commit()
     conn.close()
 
 def parse_date(text: str) -> Optional[str]:
-    if not text:
+    # Caption brevi o senza cifre (la maggior parte): scartate senza passare dalla regex completa.
+    # 8 = lunghezza minima di una data ("1/1/2026")
+    if not text or len(text) < 8 or not _DIGIT_RE.search(text):
         return None
-    for pat in DATE_PATTERNS:
-        m = re.search(pat, text)
-        if m:
-            try:
-                d = int(m.group('d')); mth = int(m.group('m')); y = int(m.group('y'))
-                return datetime(y, mth, d).strftime('%Y-%m-%d')
-            except Exception:
-                continue
+    for m in _DATE_RE.finditer(text):
+        if text[m.end():m.end() + 1].isdigit():
+            continue
+        try:
+            if m.group('d1') is not None:
+                d, mth, y = int(m.group('d1')), int(m.group('m1')), int(m.group('y1'))
+            else:
+                d, mth, y = int(m.group('d2')), int(m.group('m2')), int(m.group('y2'))
+            return datetime(y, mth, d).strftime('%Y-%m-%d')
+        except Exception:
+            continue
+    return None
+
+def iso_to_ord(date_iso: str) -> int:
+    """"2026-02-14" -> 20260214 (colonna shifts.date_ord)."""
+    return int(date_iso.replace("-", ""))
+
+def iso_to_human(date_iso: str) -> str:
+    """"2026-02-14" -> "14/02/2026" (slicing: date_iso è sempre YYYY-MM-DD, niente strptime)."""
+    return f"{date_iso[8:10]}/{date_iso[5:7]}/{date_iso[:4]}"
+
+def ord_to_iso(date_ord: str) -> str:
+    """"20260214" -> "2026-02-14" (date compatte nei callback_data)."""
+    return f"{date_ord[:4]}-{date_ord[4:6]}-{date_ord[6:]}"
+
+def is_valid_iso(date_iso: str) -> bool:
+    """True se la stringa è una data YYYY-MM-DD plausibile (mese 1-12, giorno 1-31)."""
+    m = _ISO_RE.match(date_iso or "")
+    return bool(m) and 1 <= int(m.group(2)) <= 12 and 1 <= int(m.group(3)) <= 31
+
+def decode_calendar_cb(data: str) -> Optional[Tuple[str, str]]:
+    """Converte un callback compatto del calendario in (kind, resto) come il formato legacy "KIND|resto".
+
+    "S20260214"  -> ("SETDATE", "2026-02-14")
+    "NR20260301" -> ("NAV", "SEARCH|2026-03-01")
+    Ritorna None se non è un callback compatto (es. "CLOSE|12", "IGNORE").
+    """
+    if len(data) < 9 or len(data) > 10 or not data[-8:].isdigit():
+        return None
+    date_iso = ord_to_iso(data[-8:])
+    head = data[:-8]
+    if head in CAL_CODE_MODES:
+        return CAL_CODE_MODES[head], date_iso
+    if len(head) == 2 and head[0] == CAL_NAV_CODE and head[1] in CAL_CODE_MODES:
+        return "NAV", f"{CAL_CODE_MODES[head[1]]}|{date_iso}"
     return None
 
 def is_admin_for_org(user_id: int, org: str) -> bool:
     return user_id in ORG_ADMINS.get(org, set())
 
 def upsert_user(user_id: int, username: str, full_name: str, org: Optional[str], status: Optional[str] = None):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    exists = cur.fetchone()
-    if exists:
-        if status is None:
-            cur.execute("""
-                UPDATE users SET username=?, full_name=?, org=COALESCE(?, org)
-                WHERE user_id=?
-            """, (username, full_name, org, user_id))
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
+        exists = cur.fetchone()
+        if exists:
+            if status is None:
+                cur.execute("""
+                    UPDATE users SET username=?, full_name=?, org=COALESCE(?, org)
+                    WHERE user_id=?
+                """, (username, full_name, org, user_id))
+            else:
+                cur.execute("""
+                    UPDATE users SET username=?, full_name=?, org=COALESCE(?, org), status=?
+                    WHERE user_id=?
+                """, (username, full_name, org, status, user_id))
         else:
             cur.execute("""
-                UPDATE users SET username=?, full_name=?, org=COALESCE(?, org), status=?
-                WHERE user_id=?
-            """, (username, full_name, org, status, user_id))
-    else:
-        cur.execute("""
-            INSERT INTO users(user_id, username, full_name, org, status)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, username, full_name, org, status or "pending"))
-    conn.commit()
-    conn.close()
+                INSERT INTO users(user_id, username, full_name, org, status)
+                VALUES (?, ?, ?, ?, ?)
+            """, (user_id, username, full_name, org, status or "pending"))
 
 def get_user_row(user_id: int) -> Optional[Tuple[int, Optional[str], str]]:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, org, status FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, org, status FROM users WHERE user_id=?", (user_id,))
+        row = cur.fetchone()
     return row  # (user_id, org, status) or None
 
 
@@ -504,12 +876,9 @@ async def tutorial_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("✉️ Ti ho inviato la guida in privato.")
         return
     except Forbidden:
-        bot_username = ctx.bot.username or "this_bot"
-        url = f"https://t.me/{bot_username}?start=start"
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔒 Apri chat privata col bot", url=url)]])
         await update.effective_message.reply_text(
-            "Per leggere la guida devi prima aprire la chat privata con me:",
-            reply_markup=kb
+            OPEN_PRIVATE_PROMPT,
+            reply_markup=_deeplink_kb(ctx.bot.username or "this_bot")
         )
         return
 
@@ -583,9 +952,6 @@ async def stats_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     cutoff = datetime.now(TZ) - timedelta(days=days)
 
-    # pattern: [2026-02-06 23:40:59,367] INFO event=tutorial user_id=...
-    ts_re = re.compile(r"^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+\]\s+\w+\s+(.*)$")
-
     event_counts: Dict[str, int] = {}
     org_counts: Dict[str, int] = {}
     user_ids: set[int] = set()
@@ -596,7 +962,7 @@ async def stats_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             for line in f:
                 if "event=" not in line:
                     continue
-                m = ts_re.match(line.rstrip("\n"))
+                m = LOG_LINE_RE.match(line.rstrip("\n"))
                 if not m:
                     continue
                 try:
@@ -665,56 +1031,53 @@ async def stats_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     log_event("stats", admin_id=u.id, days=days, total=total)
 
 def count_total_open_shifts() -> int:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM shifts WHERE status='open'")
-    n = int(cur.fetchone()[0])
-    conn.close()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM shifts WHERE status='open'")
+        n = int(cur.fetchone()[0])
     return n
 
-def has_open_on_date(user_id: int, date_iso: str) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""SELECT 1 FROM shifts
-                   WHERE user_id=? AND date_iso=? AND status='open'
-                   LIMIT 1""", (user_id, date_iso))
-    row = cur.fetchone()
-    conn.close()
-    return row is not None
-
 def save_shift_raw(chat_id: int, message_id: int, user_id: Optional[int],
                    username: Optional[str], caption: str, date_iso: str,
                    org: Optional[str], file_id: Optional[str] = None) -> int:
+    """Salva un turno aperto. Ritorna l'id, -1 se manca il reparto, -2 se l'utente ha già un turno aperto quel giorno."""
     # Enforce org isolation: never save a shift without a valid org.
     if not org:
         # Try to infer from user_id (safety net)
         if user_id:
             org = get_approved_org(user_id)
         if not org:
-            print(f"[ShiftBot] Refusing to save shift: missing org (chat_id={chat_id}, message_id={message_id}, user_id={user_id})")
+            logger.warning(f"[ShiftBot] Refusing to save shift: missing org (chat_id={chat_id}, message_id={message_id}, user_id={user_id})")
             return -1
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO shifts(chat_id, message_id, user_id, username, date_iso, caption, photo_file_id, org, status)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'open')""",
-        (chat_id, message_id, user_id, (username or ""), date_iso, caption or "", file_id, org)
-    )
-    conn.commit()
-    new_id = cur.lastrowid
-    conn.close()
-    return new_id
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            _SQL_INSERT_SHIFT,
+            (chat_id, message_id, user_id, (username or ""), date_iso, iso_to_ord(date_iso), caption or "", file_id, org,
+             user_id, date_iso)
+        )
+        row = cur.fetchone()
+    return row[0] if row else -2
 
-async def save_shift(msg: Message, date_iso: str) -> int:
-    username = ""
-    if msg.from_user:
-        username = f"@{msg.from_user.username}" if msg.from_user.username else msg.from_user.full_name
-    file_id = None
+def _image_file_id(msg: Message) -> Optional[str]:
+    """file_id della foto (risoluzione massima) o del documento immagine; None altrimenti."""
     if msg.photo:
-        file_id = msg.photo[-1].file_id
-    elif getattr(msg, "document", None) and getattr(msg.document, "mime_type", "").startswith("image/"):
-        file_id = msg.document.file_id
+        return msg.photo[-1].file_id
+    doc = msg.document
+    if doc and (doc.mime_type or "").startswith("image/"):
+        return doc.file_id
+    return None
+
+def _fmt_username(user) -> str:
+    """Autore salvato sul turno: "@handle", oppure nome completo (legacy) se manca lo username."""
+    if not user:
+        return ""
+    return f"@{user.username}" if user.username else user.full_name
+
+async def save_shift(msg: Message, date_iso: str) -> int:
+    username = _fmt_username(msg.from_user)
+    file_id = _image_file_id(msg)
     org = None
     if msg.from_user:
         org = get_approved_org(msg.from_user.id)
@@ -863,14 +1226,7 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     log_event("auth_needed", user_id=u.id, org=org, status=status)
-    await update.effective_message.reply_text(
-        WELCOME_TEXT + "\n\n"
-        "📌 Inserisci il codice reparto:\n"
-        f"• `{ORG_PDCNAFR}` = {ORG_LABELS[ORG_PDCNAFR]}\n"
-        f"• `{ORG_PDBNAFR}` = {ORG_LABELS[ORG_PDBNAFR]}\n\n"
-        "Esempio:\n`/start PDCFRNA`",
-        parse_mode="Markdown"
-    )
+    await update.effective_message.reply_text(START_AUTH_HTML, parse_mode="HTML")
 
 async def myid_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
@@ -909,17 +1265,16 @@ async def pending_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     log_event("pending_list", admin_id=admin.id, org=admin_org)
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT user_id, full_name, username
-        FROM users
-        WHERE status='pending' AND org=?
-        ORDER BY created_at ASC
-        LIMIT 100
-    """, (admin_org,))
-    rows = cur.fetchall()
-    conn.close()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT user_id, full_name, username
+            FROM users
+            WHERE status='pending' AND org=?
+            ORDER BY created_at ASC
+            LIMIT 100
+        """, (admin_org,))
+        rows = cur.fetchall()
 
     if not rows:
         await update.effective_message.reply_text("✅ Nessun utente in attesa.")
@@ -932,7 +1287,7 @@ async def pending_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton("✅ Approva", callback_data=f"APPROVE|{uid}|{admin_org}"),
             InlineKeyboardButton("⛔ Rifiuta", callback_data=f"REJECT|{uid}|{admin_org}")
         ]])
-        await ctx.bot.send_message(chat_id=admin.id, text=f"• {name_line}\nID: {uid}", reply_markup=kb)
+        await safe_send(lambda: ctx.bot.send_message(chat_id=admin.id, text=f"• {name_line}\nID: {uid}", reply_markup=kb), admin.id)
 
 
 
@@ -985,19 +1340,18 @@ async def approved_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     log_event("approved_list", admin_id=admin.id, org=admin_org)
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT user_id, full_name, username, created_at
-        FROM users
-        WHERE status='approved' AND org=?
-        ORDER BY created_at ASC
-        """,
-        (admin_org,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT user_id, full_name, username, created_at
+            FROM users
+            WHERE status='approved' AND org=?
+            ORDER BY created_at ASC
+            """,
+            (admin_org,),
+        )
+        rows = cur.fetchall()
 
     label = ORG_LABELS.get(admin_org, admin_org)
 
@@ -1064,19 +1418,18 @@ async def _approved_list_for_org(update: Update, ctx: ContextTypes.DEFAULT_TYPE,
         await update.effective_message.reply_text("❌ Reparto non valido.")
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT user_id, full_name, username, created_at
-        FROM users
-        WHERE status='approved' AND org=?
-        ORDER BY created_at ASC
-        """,
-        (org_code,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT user_id, full_name, username, created_at
+            FROM users
+            WHERE status='approved' AND org=?
+            ORDER BY created_at ASC
+            """,
+            (org_code,),
+        )
+        rows = cur.fetchall()
 
     label = ORG_LABELS.get(org_code, org_code)
 
@@ -1235,28 +1588,22 @@ async def revoke_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             target_uid = None
 
     if target_uid is not None:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, full_name, username, org, status FROM users WHERE user_id=?", (target_uid,))
-        r = cur.fetchone()
+        with pool_acquire() as conn:
+            r = conn.execute("SELECT user_id, full_name, username, org, status FROM users WHERE user_id=?", (target_uid,)).fetchone()
         if not r:
-            conn.close()
             await update.effective_message.reply_text("❌ Utente non trovato.")
             return
 
         uid, full_name, username, org, ustatus = r
         if org != admin_org:
-            conn.close()
             await update.effective_message.reply_text("⛔ Puoi revocare solo utenti del tuo reparto.")
             return
         if ustatus != "approved":
-            conn.close()
             await update.effective_message.reply_text("ℹ️ Questo utente non è in stato approved.")
             return
 
-        cur.execute("UPDATE users SET status='pending' WHERE user_id=? AND org=?", (uid, admin_org))
-        conn.commit()
-        conn.close()
+        with pool_acquire() as conn:
+            conn.execute("UPDATE users SET status='pending' WHERE user_id=? AND org=?", (uid, admin_org))
         log_event("revoke_done", admin_id=admin.id, org=admin_org, target_uid=uid)
 
         name = (full_name or "utente") + (f" ({username})" if username else "")
@@ -1275,20 +1622,19 @@ async def revoke_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     # Lista approvati con pulsanti Revoca
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT user_id, full_name, username, created_at
-        FROM users
-        WHERE status='approved' AND org=?
-        ORDER BY created_at ASC
-        LIMIT 200
-        """,
-        (admin_org,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT user_id, full_name, username, created_at
+            FROM users
+            WHERE status='approved' AND org=?
+            ORDER BY created_at ASC
+            LIMIT 200
+            """,
+            (admin_org,),
+        )
+        rows = cur.fetchall()
 
     label = ORG_LABELS.get(admin_org, admin_org)
 
@@ -1305,7 +1651,7 @@ async def revoke_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("🧯 Revoca", callback_data=f"REVOKE|{uid}|{admin_org}")]
         ])
-        await ctx.bot.send_message(chat_id=admin.id, text=f"• {name}\nID: {uid}", reply_markup=kb)
+        await safe_send(lambda: ctx.bot.send_message(chat_id=admin.id, text=f"• {name}\nID: {uid}", reply_markup=kb), admin.id)
 
 
 # -------------------- Admin dashboard command --------------------
@@ -1336,49 +1682,49 @@ async def admin_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     log_event("admin_dashboard", admin_id=u.id)
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
 
-    # Reparti dinamici: union di quelli presenti in users e shifts
-    cur.execute(
-        """
-        SELECT org FROM (
-            SELECT DISTINCT org AS org FROM users  WHERE org IS NOT NULL AND org <> ''
-            UNION
-            SELECT DISTINCT org AS org FROM shifts WHERE org IS NOT NULL AND org <> ''
+        # Reparti dinamici: union di quelli presenti in users e shifts
+        cur.execute(
+            """
+            SELECT org FROM (
+                SELECT DISTINCT org AS org FROM users  WHERE org IS NOT NULL AND org <> ''
+                UNION
+                SELECT DISTINCT org AS org FROM shifts WHERE org IS NOT NULL AND org <> ''
+            )
+            ORDER BY org ASC
+            """
         )
-        ORDER BY org ASC
-        """
-    )
-    orgs = [r[0] for r in cur.fetchall()]
+        orgs = [r[0] for r in cur.fetchall()]
 
-    lines = ["📊 Dashboard Admin (tutti i reparti)", ""]
+        lines = ["📊 Dashboard Admin (tutti i reparti)", ""]
 
-    total_approved = 0
-    total_pending = 0
-    total_open_shifts = 0
+        total_approved = 0
+        total_pending = 0
+        total_open_shifts = 0
 
-    for org_code in orgs:
-        org_label = ORG_LABELS.get(org_code, org_code)
+        for org_code in orgs:
+            org_label = ORG_LABELS.get(org_code, org_code)
 
-        cur.execute("SELECT COUNT(*) FROM users WHERE status='approved' AND org=?", (org_code,))
-        approved = int(cur.fetchone()[0])
+            cur.execute("SELECT COUNT(*) FROM users WHERE status='approved' AND org=?", (org_code,))
+            approved = int(cur.fetchone()[0])
 
-        cur.execute("SELECT COUNT(*) FROM users WHERE status='pending' AND org=?", (org_code,))
-        pending = int(cur.fetchone()[0])
+            cur.execute("SELECT COUNT(*) FROM users WHERE status='pending' AND org=?", (org_code,))
+            pending = int(cur.fetchone()[0])
 
-        cur.execute("SELECT COUNT(*) FROM shifts WHERE status='open' AND org=?", (org_code,))
-        open_shifts = int(cur.fetchone()[0])
+            cur.execute("SELECT COUNT(*) FROM shifts WHERE status='open' AND org=?", (org_code,))
+            open_shifts = int(cur.fetchone()[0])
 
-        total_approved += approved
-        total_pending += pending
-        total_open_shifts += open_shifts
+            total_approved += approved
+            total_pending += pending
+            total_open_shifts += open_shifts
 
-        lines.append(f"🏷️ {org_label} ({org_code})")
-        lines.append(f"👥 Approvati: {approved}")
-        lines.append(f"⏳ In attesa: {pending}")
-        lines.append(f"📅 Turni aperti: {open_shifts}")
-        lines.append("")
+            lines.append(f"🏷️ {org_label} ({org_code})")
+            lines.append(f"👥 Approvati: {approved}")
+            lines.append(f"⏳ In attesa: {pending}")
+            lines.append(f"📅 Turni aperti: {open_shifts}")
+            lines.append("")
 
     # Info backup (ultimo file) + dimensione DB
     try:
@@ -1391,8 +1737,6 @@ async def admin_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     except Exception:
         db_size = 0
 
-    conn.close()
-
     lines.append("—")
     lines.append(f"👥 Totale approvati: {total_approved}")
     lines.append(f"⏳ Totale pending: {total_pending}")
@@ -1477,7 +1821,7 @@ async def logs_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def help_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
         return
-    await update.effective_message.reply_text(WELCOME_TEXT, parse_mode="Markdown")
+    await update.effective_message.reply_text(WELCOME_HTML, parse_mode="HTML")
 
 async def version_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
@@ -1498,26 +1842,19 @@ async def show_shifts(update: Update, ctx: ContextTypes.DEFAULT_TYPE, date_iso:
     else:
         requester_org = None
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    if requester_org:
-        cur.execute("""SELECT id, chat_id, message_id, user_id, username, caption, photo_file_id
-                       FROM shifts
-                       WHERE date_iso=? AND status='open' AND org=?
-                       ORDER BY created_at ASC""", (date_iso, requester_org))
-    else:
-        cur.execute("""SELECT id, chat_id, message_id, user_id, username, caption, photo_file_id
-                       FROM shifts
-                       WHERE date_iso=? AND status='open'
-                       ORDER BY created_at ASC""", (date_iso,))
-    rows = cur.fetchall()
-    conn.close()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        if requester_org:
+            cur.execute(_SQL_DATE_SHIFTS_ORG, (date_iso, requester_org))
+        else:
+            cur.execute(_SQL_DATE_SHIFTS, (date_iso,))
+        rows = cur.fetchall()
 
     if not rows:
         await update.effective_message.reply_text("Nessun turno salvato per quella data.", reply_markup=PRIVATE_KB)
         return
 
-    human = datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
+    human = iso_to_human(date_iso)
     await update.effective_message.reply_text(
         f"📅 Turni trovati per *{human}*: {len(rows)}",
         parse_mode="Markdown",
@@ -1526,50 +1863,43 @@ async def show_shifts(update: Update, ctx: ContextTypes.DEFAULT_TYPE, date_iso:
 
     for (sid, chat_id, message_id, _user_id, _username, _caption, file_id) in rows:
         # Pulsante diretto: apre subito la chat dell'autore (se ha username)
-        handle = None
-        if _username and isinstance(_username, str) and _username.startswith("@") and len(_username) > 1:
-            handle = _username[1:]
+        link = author_link(_username)
 
         # Fallback: prova a leggere username aggiornato dalla tabella users (per turni legacy)
-        if not handle and _user_id:
+        if not link and _user_id:
             try:
-                conn2 = sqlite3.connect(DB_PATH)
-                cur2 = conn2.cursor()
-                cur2.execute("SELECT username FROM users WHERE user_id=?", (_user_id,))
-                r2 = cur2.fetchone()
-                conn2.close()
-                if r2 and r2[0] and isinstance(r2[0], str) and r2[0].startswith("@") and len(r2[0]) > 1:
-                    handle = r2[0][1:]
+                with pool_acquire() as conn2:
+                    cur2 = conn2.cursor()
+                    cur2.execute("SELECT username FROM users WHERE user_id=?", (_user_id,))
+                    r2 = cur2.fetchone()
+                link = author_link(r2[0]) if r2 else None
             except Exception:
-                handle = None
+                link = None
 
-        if handle:
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton("📩 Contatta autore", url=f"https://t.me/{handle}")]])
+        if link:
+            kb = _contact_url_kb(link[0])
         else:
-            # Se non c'è username, mantieni il vecchio callback per mostrare il messaggio di avviso
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton("📩 Contatta autore", callback_data=f"CONTACT|{sid}")]])
-        sent_mid = None
+            # Se non c'è username, mantieni il vecchio callback per mostrare il messaggio di avviso.
+            # Solo l'id: callback_data è forgiabile, autore e reparto si leggono sempre dal DB.
+            cb = f"CONTACT|{sid}"
+            kb = InlineKeyboardMarkup([[InlineKeyboardButton("📩 Contatta autore", callback_data=cb)]])
+        # Copia + pulsante in una sola chiamata (copyMessage accetta reply_markup): 1 round-trip per turno
         try:
-            copied = await ctx.bot.copy_message(chat_id=update.effective_chat.id,
-                                                from_chat_id=chat_id, message_id=message_id)
-            sent_mid = getattr(copied, "message_id", None)
-            if sent_mid:
-                try:
-                    await ctx.bot.edit_message_reply_markup(update.effective_chat.id, sent_mid, reply_markup=kb)
-                    continue
-                except BadRequest:
-                    pass
+            await safe_send(lambda: ctx.bot.copy_message(chat_id=update.effective_chat.id,
+                                                         from_chat_id=chat_id, message_id=message_id,
+                                                         reply_markup=kb), update.effective_chat.id)
+            continue
         except Exception:
             pass
 
         if file_id:
             try:
-                await ctx.bot.send_photo(chat_id=update.effective_chat.id, photo=file_id, reply_markup=kb)
+                await safe_send(lambda: ctx.bot.send_photo(chat_id=update.effective_chat.id, photo=file_id, reply_markup=kb), update.effective_chat.id)
                 continue
             except Exception:
                 pass
 
-        await ctx.bot.send_message(chat_id=update.effective_chat.id, text="(Immagine non disponibile)", reply_markup=kb)
+        await safe_send(lambda: ctx.bot.send_message(chat_id=update.effective_chat.id, text="(Immagine non disponibile)", reply_markup=kb), update.effective_chat.id)
 
 async def search_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
@@ -1598,13 +1928,10 @@ async def dates_list_dm(ctx: ContextTypes.DEFAULT_TYPE, user_id: int):
     if not org:
         await ctx.bot.send_message(chat_id=user_id, text="⛔ Non sei registrato.")
         return
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""SELECT date_iso, COUNT(*) FROM shifts
-                   WHERE status='open' AND org=?
-                   GROUP BY date_iso ORDER BY date_iso ASC""", (org,))
-    rows = cur.fetchall()
-    conn.close()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.execute(_SQL_DATES_AGG, (org,))
+        rows = cur.fetchall()
 
     if not rows:
         await ctx.bot.send_message(chat_id=user_id, text="Non ci sono turni aperti al momento.", reply_markup=PRIVATE_KB)
@@ -1613,7 +1940,7 @@ async def dates_list_dm(ctx: ContextTypes.DEFAULT_TYPE, user_id: int):
     total = sum(int(c) for _, c in rows)
     lines = ["🗓️ *Date con turni aperti:*", ""]
     for date_iso, count in rows:
-        d = datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
+        d = iso_to_human(date_iso)
         lines.append(f"• {d}: {count}")
     lines.append("")
     lines.append(f"📌 *Totale turni aperti:* {total}")
@@ -1647,42 +1974,55 @@ async def miei_list_dm(ctx: ContextTypes.DEFAULT_TYPE, user_id: int):
     if not org:
         await ctx.bot.send_message(chat_id=user_id, text="⛔ Non sei registrato.")
         return
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""SELECT id, chat_id, message_id, date_iso, caption, photo_file_id
-                   FROM shifts
-                   WHERE user_id=? AND status='open' AND org=?
-                   ORDER BY created_at DESC
-                   LIMIT 50""", (user_id, org))
-    rows = cur.fetchall()
-    conn.close()
+    with pool_acquire() as conn:
+        cur = conn.cursor()
+        cur.arraysize = MY_SHIFTS_LIMIT
+        cur.execute(_SQL_MY_SHIFTS, (user_id, org, MY_SHIFTS_LIMIT))
+        rows = cur.fetchmany()
 
     if not rows:
         await ctx.bot.send_message(chat_id=user_id, text="Non hai turni aperti al momento.", reply_markup=PRIVATE_KB)
         return
 
     await ctx.bot.send_message(chat_id=user_id, text="🧾 I tuoi turni aperti:", reply_markup=PRIVATE_KB)
-    for sid, chat_id, message_id, date_iso, caption, file_id in rows:
-        human = datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
-        copied = False
+    # Invii in sequenza: stessa chat, l'ordine per data della query deve arrivare intatto
+    for row in rows:
         try:
-            await ctx.bot.copy_message(chat_id=user_id, from_chat_id=chat_id, message_id=message_id)
-            copied = True
+            await _send_my_shift(ctx, user_id, row)
         except Exception:
-            if file_id:
-                try:
-                    await ctx.bot.send_photo(chat_id=user_id, photo=file_id)
-                    copied = True
-                except Exception:
-                    pass
-        if not copied:
-            await ctx.bot.send_message(chat_id=user_id, text=f"📄 {human} (immagine non disponibile)")
-
-        await ctx.bot.send_message(
-            chat_id=user_id,
-            text=f"📅 {human}\n{caption or ''}".strip(),
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Risolto", callback_data=f"CLOSE|{sid}")]])
-        )
+            pass
+
+# Limite Telegram per le caption (unità UTF-16, come le conta l'API)
+CAPTION_MAX = 1024
+
+def _clip_caption(text: str) -> str:
+    """Tronca la caption a CAPTION_MAX unità UTF-16 (un surrogato spezzato viene scartato)."""
+    raw = text.encode("utf-16-le")
+    if len(raw) <= CAPTION_MAX * 2:
+        return text
+    return raw[:(CAPTION_MAX - 1) * 2].decode("utf-16-le", "ignore") + "…"
+
+async def _send_my_shift(ctx: ContextTypes.DEFAULT_TYPE, user_id: int, row: tuple):
+    """Un messaggio per turno: immagine con data/caption e pulsante Risolto."""
+    sid, chat_id, message_id, date_iso, caption, file_id = row
+    human = iso_to_human(date_iso)
+    text = f"📅 {human}\n{caption or ''}".strip()
+    # la data in testa può far sforare i 1024 caratteri: in quel caso copy/send_photo fallirebbero entrambi
+    photo_caption = _clip_caption(text)
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Risolto", callback_data=f"CLOSE|{sid}")]])
+    try:
+        await safe_send(lambda: ctx.bot.copy_message(chat_id=user_id, from_chat_id=chat_id, message_id=message_id,
+                                                     caption=photo_caption, reply_markup=kb), user_id)
+        return
+    except Exception:
+        pass
+    if file_id:
+        try:
+            await safe_send(lambda: ctx.bot.send_photo(chat_id=user_id, photo=file_id, caption=photo_caption, reply_markup=kb), user_id)
+            return
+        except Exception:
+            pass
+    await safe_send(lambda: ctx.bot.send_message(chat_id=user_id, text=f"📄 {text}\n(immagine non disponibile)", reply_markup=kb), user_id)
 
 async def miei_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
@@ -1701,39 +2041,38 @@ async def miei_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             pass
 
 # -------------------- Calendar --------------------
-def build_calendar(base_date: datetime, mode="SETDATE") -> InlineKeyboardMarkup:
-    year, month = base_date.year, base_date.month
-    first_day = datetime(year, month, 1)
-    next_month = (first_day.replace(day=28) + timedelta(days=4)).replace(day=1)
-    prev_month = (first_day - timedelta(days=1)).replace(day=1)
-
-    keyboard = []
-    keyboard.append([InlineKeyboardButton(f"{month:02d}/{year}", callback_data="IGNORE")])
-    keyboard.append([InlineKeyboardButton(d, callback_data="IGNORE") for d in ["L","M","M","G","V","S","D"]])
-
-    week = []
-    for _ in range(first_day.weekday()):
-        week.append(InlineKeyboardButton(" ", callback_data="IGNORE"))
-
-    day = first_day
-    while day.month == month:
-        cb = f"{mode}|{day.strftime('%Y-%m-%d')}"
-        week.append(InlineKeyboardButton(str(day.day), callback_data=cb))
-        if len(week) == 7:
-            keyboard.append(week); week = []
-        day += timedelta(days=1)
-
-    if week:
-        while len(week) < 7:
-            week.append(InlineKeyboardButton(" ", callback_data="IGNORE"))
-        keyboard.append(week)
-
+# Bottoni fissi del calendario: InlineKeyboardButton è immutabile, si possono riusare
+_CAL_EMPTY_BTN = InlineKeyboardButton(" ", callback_data="IGNORE")
+_WEEKDAY_ROW = tuple(InlineKeyboardButton(d, callback_data="IGNORE") for d in ("L", "M", "M", "G", "V", "S", "D"))
+
+# La tastiera dipende solo da (anno, mese, modo) e gli oggetti PTB sono immutabili: si riusa
+@lru_cache(maxsize=256)
+def _cached_calendar(year: int, month: int, mode: str) -> InlineKeyboardMarkup:
+    code = CAL_MODE_CODES[mode]
+    first_weekday, days_in_month = calendar.monthrange(year, month)
+    prev_y, prev_m = (year - 1, 12) if month == 1 else (year, month - 1)
+    next_y, next_m = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    # celle vuote prima del giorno 1 e dopo l'ultimo, fino a settimane complete
+    prefix = f"{code}{year:04d}{month:02d}"
+    cells = [_CAL_EMPTY_BTN] * first_weekday
+    cells += [InlineKeyboardButton(str(d), callback_data=f"{prefix}{d:02d}") for d in range(1, days_in_month + 1)]
+    cells += [_CAL_EMPTY_BTN] * (-len(cells) % 7)
+
+    keyboard = [
+        [InlineKeyboardButton(f"{month:02d}/{year}", callback_data="IGNORE")],
+        _WEEKDAY_ROW,
+    ]
+    keyboard += [cells[i:i + 7] for i in range(0, len(cells), 7)]
     keyboard.append([
-        InlineKeyboardButton("<", callback_data=f"NAV|{mode}|{prev_month.strftime('%Y-%m-%d')}"),
-        InlineKeyboardButton(">", callback_data=f"NAV|{mode}|{next_month.strftime('%Y-%m-%d')}"),
+        InlineKeyboardButton("<", callback_data=f"{CAL_NAV_CODE}{code}{prev_y:04d}{prev_m:02d}01"),
+        InlineKeyboardButton(">", callback_data=f"{CAL_NAV_CODE}{code}{next_y:04d}{next_m:02d}01"),
     ])
     return InlineKeyboardMarkup(keyboard)
 
+def build_calendar(base_date: datetime, mode="SETDATE") -> InlineKeyboardMarkup:
+    return _cached_calendar(base_date.year, base_date.month, mode)
+
 # -------------------- Upload handler (PRIVATE) --------------------
 async def photo_or_doc_image_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Ora gestiamo upload SOLO in privato (approvato)
@@ -1751,30 +2090,29 @@ async def photo_or_doc_image_handler(update: Update, ctx: ContextTypes.DEFAULT_T
 
     if not date_iso:
         kb = build_calendar(datetime.now(TZ), mode="SETDATE")
-        file_id = (msg.photo[-1].file_id if msg.photo else
-                   (msg.document.file_id if getattr(msg, "document", None) and getattr(msg.document, "mime_type", "").startswith("image/") else None))
+        file_id = _image_file_id(msg)
         cal = await msg.reply_text("📅 Seleziona la data per questo turno:", reply_markup=kb)
-        PENDING[cal.message_id] = {
-            "src_chat_id": msg.chat.id,
-            "src_msg_id": msg.message_id,
-            "owner_id": (msg.from_user.id if msg.from_user else None),
-            "owner_username": (f"@{msg.from_user.username}" if msg.from_user and msg.from_user.username else (msg.from_user.full_name if msg.from_user else "")),
-            "caption": caption,
-            "file_id": file_id,
-        }
+        pending_put(cal.message_id, _Pending(
+            src_chat_id=msg.chat.id,
+            src_msg_id=msg.message_id,
+            owner_id=(msg.from_user.id if msg.from_user else None),
+            owner_username=_fmt_username(msg.from_user),
+            caption=caption,
+            file_id=file_id,
+            inserted_at=time.monotonic(),
+        ))
         return
 
     owner_id = msg.from_user.id if msg.from_user else None
-    if owner_id and has_open_on_date(owner_id, date_iso):
-        human = datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
+    saved_id = await save_shift(msg, date_iso)
+    if saved_id == -2:
+        human = iso_to_human(date_iso)
         await msg.reply_text(
             f"⛔ Hai già un turno *aperto* per il {human}.\n"
             f"Chiudi quello esistente con *Risolto* oppure usa *I miei turni*.",
             parse_mode="Markdown"
         )
         return
-
-    saved_id = await save_shift(msg, date_iso)
     if saved_id == -1:
         log_event("upload_denied", user_id=(msg.from_user.id if msg.from_user else None), reason="missing_org")
         await msg.reply_text(
@@ -1784,7 +2122,7 @@ async def photo_or_doc_image_handler(update: Update, ctx: ContextTypes.DEFAULT_T
         )
         return
 
-    human = datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
+    human = iso_to_human(date_iso)
     log_event("upload_saved", user_id=owner_id, org=get_approved_org(owner_id) if owner_id else None, date_iso=date_iso, shift_id=saved_id)
 
     # Tutorial evoluto: Step 1 (primo upload salvato)
@@ -1797,464 +2135,481 @@ async def photo_or_doc_image_handler(update: Update, ctx: ContextTypes.DEFAULT_T
     await msg.reply_text(f"✅ Turno registrato per il {human}", reply_markup=PRIVATE_KB)
 
 # -------------------- Callback handler --------------------
-def mention_html(user_id: Optional[int], username: Optional[str]) -> str:
-    if username and isinstance(username, str) and username.startswith("@") and len(username) > 1:
-        return username
-    if user_id:
-        return f'<a href="tg://user?id={user_id}">utente</a>'
-    return "utente"
-
-async def button_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    # Username gate: se manca username, blocca qualsiasi pulsante/callback
-    ok_user = await _gate_username_for_callbacks(update, ctx)
-    if not ok_user:
-        return
-    parts = (query.data or "").split("|")
-
-    # ---- NAV ----
-    if parts[0] == "NAV":
-        if len(parts) < 3:
-            return
-        date_str = parts[-1]
-        mode = "|".join(parts[1:-1])
-        try:
-            new_month = datetime.strptime(date_str, "%Y-%m-%d")
-        except Exception:
-            return
-        kb = build_calendar(new_month, mode)
-        await query.edit_message_reply_markup(reply_markup=kb)
-        return
+def _tg_handle(username: Optional[str]) -> Optional[str]:
+    """Estrae l'handle da "@handle"; None se vuoto, nome completo (legacy) o non valido."""
+    m = USERNAME_RE.match(username or "")
+    return m.group(1) if m else None
 
-    # ---- SETDATE ----
-    if parts[0] == "SETDATE":
-        date_iso = parts[1]
-        cal_msg_id = query.message.message_id if query.message else None
-        data = PENDING.pop(cal_msg_id, None)
-        if not data:
-            await query.edit_message_text("❌ Non riesco a collegare il calendario al messaggio. Rimanda la foto.")
-            return
+@lru_cache(maxsize=1024)
+def author_link(username: Optional[str]) -> Optional[Tuple[str, str]]:
+    """(url t.me, "@handle") dell'autore, o None se lo username non è un handle valido.
 
-        owner_id = data["owner_id"]
-        if owner_id and has_open_on_date(owner_id, date_iso):
-            human = datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
-            await query.edit_message_text(
-                f"⛔ Hai già un turno aperto per il {human}.\nUsa *I miei turni* per gestire.",
-                parse_mode="Markdown"
-            )
-            return
+    In cache: gli stessi autori ricorrono in ogni ricerca/contatto.
+    """
+    handle = _tg_handle(username)
+    if not handle:
+        return None
+    return f"https://t.me/{handle}", f"@{handle}"
 
-        owner_org = get_approved_org(owner_id) if owner_id else None
-        if not owner_org:
-            await query.edit_message_text(
-                "⛔ Non posso registrare il turno perché non risulti più *approvato* in un reparto.\n"
-                "Rifai /start con il tuo codice reparto e riprova.",
-                parse_mode="Markdown"
-            )
-            return
+async def _callback_alert(query, text: str) -> None:
+    """Avviso su una callback, come messaggio in chat.
 
-        new_id = save_shift_raw(
-            chat_id=data["src_chat_id"],
-            message_id=data["src_msg_id"],
-            user_id=owner_id,
-            username=data.get("owner_username", ""),
-            caption=data.get("caption", ""),
-            date_iso=date_iso,
-            org=owner_org,
-            file_id=data.get("file_id"),
-        )
-        if new_id == -1:
-            await query.edit_message_text(
-                "⛔ Non posso registrare il turno: reparto non valido.\nRifai /start e riprova.",
-                parse_mode="Markdown"
-            )
-            return
+    Il gate username ha già risposto alla callback (spinner chiuso subito) e Telegram accetta una
+    sola answer: un query.answer(show_alert=True) qui verrebbe sempre rifiutato.
+    """
+    try:
+        await query.message.reply_text(f"⚠️ {text}")
+    except Exception:
+        pass
 
-        human = datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
-        try:
-            await ctx.bot.send_message(chat_id=owner_id, text=f"✅ Turno registrato per il {human}", reply_markup=PRIVATE_KB)
-        except Exception:
-            pass
-        # Tutorial evoluto: Step 1 completato anche quando salva da calendario
+async def _dismiss_calendar(query) -> None:
+    """Rimuove il messaggio calendario dopo la scelta (o almeno la sua tastiera)."""
+    try:
+        await query.message.delete()
+    except Exception:
         try:
-            if owner_id:
-                maybe_send_tutorial_tip(ctx, owner_id, 1)
+            await query.edit_message_reply_markup(reply_markup=None)
         except Exception:
             pass
-        try:
-            await query.message.delete()
-        except Exception:
-            try: await query.edit_message_reply_markup(reply_markup=None)
-            except Exception: pass
+
+async def _cb_nav(update: Update, ctx: ContextTypes.DEFAULT_TYPE, kind: str, rest: str):
+    """Frecce del calendario: ridisegna il mese richiesto (rest = "MODE|YYYY-MM-DD")."""
+    query = update.callback_query
+    mode, _, date_str = rest.rpartition("|")
+    if mode not in CAL_MODE_CODES or not is_valid_iso(date_str):
         return
+    new_month = datetime(int(date_str[:4]), int(date_str[5:7]), 1)
+    kb = build_calendar(new_month, mode)
+    await query.edit_message_reply_markup(reply_markup=kb)
 
-    # ---- SEARCH ----
-    if parts[0] == "SEARCH":
-        date_iso = parts[1]
-        # IMPORTANT: non usare fake_update qui. query.message è un messaggio del bot,
-        # quindi fake_update.effective_user diventerebbe il bot e l'auth fallirebbe.
-        await show_shifts(update, ctx, date_iso)
+async def _cb_setdate(update: Update, ctx: ContextTypes.DEFAULT_TYPE, kind: str, rest: str):
+    """Data scelta per un upload in attesa: salva il turno."""
+    query = update.callback_query
+    date_iso = rest
+    if not is_valid_iso(date_iso):
+        return
+    cal_msg_id = query.message.message_id if query.message else None
+    data = pending_pop(cal_msg_id)
+    if not data:
+        await query.edit_message_text("❌ Non riesco a collegare il calendario al messaggio. Rimanda la foto.")
+        return
 
-        # Tutorial evoluto: prima consultazione (Cerca da calendario)
-        try:
-            if query.from_user:
-                maybe_send_tutorial_tip(ctx, query.from_user.id, 2)
-        except Exception:
-            pass
+    owner_id = data.owner_id
+    # Query SQLite in un thread: l'event loop continua a servire gli altri update
+    owner_org = await asyncio.to_thread(get_approved_org, owner_id) if owner_id else None
+    if not owner_org:
+        await query.edit_message_text(SETDATE_NOT_APPROVED_HTML, parse_mode="HTML")
+        return
 
-        try:
-            await query.edit_message_text(
-                f"📅 Risultati mostrati per {datetime.strptime(date_iso, '%Y-%m-%d').strftime('%d/%m/%Y')}"
-            )
-        except Exception:
-            pass
+    new_id = await asyncio.to_thread(
+        save_shift_raw,
+        chat_id=data.src_chat_id,
+        message_id=data.src_msg_id,
+        user_id=owner_id,
+        username=data.owner_username,
+        caption=data.caption,
+        date_iso=date_iso,
+        org=owner_org,
+        file_id=data.file_id,
+    )
+    if new_id == -2:
+        await query.edit_message_text(SETDATE_DUP_HTML.format(human=iso_to_human(date_iso)), parse_mode="HTML")
+        return
+    if new_id == -1:
+        await query.edit_message_text(SETDATE_BAD_ORG_HTML, parse_mode="HTML")
         return
 
-    # ---- CLOSE ----
-    if parts[0] == "CLOSE":
-        try:
-            shift_id = int(parts[1])
-        except Exception:
-            await query.edit_message_text("❌ ID turno non valido.")
-            return
+    human = iso_to_human(date_iso)
+    # Conferma e rimozione del calendario sono indipendenti: in parallelo (~1 RTT invece di 2)
+    await asyncio.gather(
+        safe_send(lambda: ctx.bot.send_message(chat_id=owner_id, text=f"✅ Turno registrato per il {human}", reply_markup=PRIVATE_KB), owner_id),
+        _dismiss_calendar(query),
+        return_exceptions=True,
+    )
+    # Tutorial evoluto: Step 1 completato anche quando salva da calendario
+    try:
+        if owner_id:
+            maybe_send_tutorial_tip(ctx, owner_id, 1)
+    except Exception:
+        pass
 
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, status, date_iso FROM shifts WHERE id=?", (shift_id,))
-        row = cur.fetchone()
-        if not row:
-            conn.close()
-            await query.edit_message_text("❌ Turno non trovato.")
-            return
+async def _cb_search(update: Update, ctx: ContextTypes.DEFAULT_TYPE, kind: str, rest: str):
+    """Data scelta nel calendario di ricerca: mostra i turni."""
+    query = update.callback_query
+    date_iso = rest
+    if not is_valid_iso(date_iso):
+        return
+    # IMPORTANT: non usare fake_update qui. query.message è un messaggio del bot,
+    # quindi fake_update.effective_user diventerebbe il bot e l'auth fallirebbe.
+    await show_shifts(update, ctx, date_iso)
 
-        owner_id, status, date_iso = row
-        user = update.effective_user
-        if not user or user.id != owner_id:
-            conn.close()
-            await query.answer("Non hai i permessi.", show_alert=True)
-            return
+    # Tutorial evoluto: prima consultazione (Cerca da calendario)
+    try:
+        if query.from_user:
+            maybe_send_tutorial_tip(ctx, query.from_user.id, 2)
+    except Exception:
+        pass
 
-        cur.execute("DELETE FROM shifts WHERE id=?", (shift_id,))
-        conn.commit()
-        conn.close()
+    try:
+        await query.edit_message_text(
+            f"📅 Risultati mostrati per {iso_to_human(date_iso)}"
+        )
+    except Exception:
+        pass
 
-        human = datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m/%Y")
-        await query.edit_message_text(f"✅ Turno rimosso ({human}).")
-        # Tutorial evoluto: completato quando chiude almeno un turno
-        try:
-            if owner_id:
-                maybe_send_tutorial_tip(ctx, owner_id, 4)
-        except Exception:
-            pass
+async def _cb_close(update: Update, ctx: ContextTypes.DEFAULT_TYPE, kind: str, rest: str):
+    """"Risolto": cancella il turno se appartiene all'utente."""
+    query = update.callback_query
+    try:
+        shift_id = int(rest, 10)
+    except Exception:
+        await query.edit_message_text("❌ ID turno non valido.")
         return
 
-    # ---- CONTACT ----
-    if parts[0] == "CONTACT":
-        try:
-            shift_id = int(parts[1])
-        except Exception:
-            await query.answer("ID turno non valido.", show_alert=True)
-            return
+    user = update.effective_user
+    if not user:
+        return
 
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("""SELECT user_id, username, date_iso, org FROM shifts WHERE id=?""", (shift_id,))
-        row = cur.fetchone()
-        conn.close()
-        if not row:
-            await query.answer("Turno non trovato.", show_alert=True)
-            return
+    # Un solo statement: cancella solo se il turno è dell'utente (DELETE ... RETURNING, SQLite >= 3.35)
+    row = await db_fetchone("DELETE FROM shifts WHERE id=? AND user_id=? RETURNING date_iso", (shift_id, user.id))
+    if not row:
+        # Nessuna riga cancellata: distingui "non trovato" da "non tuo" solo in questo caso
+        if await db_fetchone("SELECT 1 FROM shifts WHERE id=?", (shift_id,)):
+            await _callback_alert(query, "Non hai i permessi.")
+        else:
+            await query.edit_message_text("❌ Turno non trovato.")
+        return
 
-        owner_id, owner_username, date_iso, shift_org = row
-        requester = update.effective_user
-        # blocca contatto cross-reparto
-        requester_org = get_approved_org(requester.id) if requester else None
-        log_event("contact_click", requester_id=(requester.id if requester else None), requester_org=(get_approved_org(requester.id) if requester else None), owner_id=owner_id, shift_org=shift_org, shift_id=shift_id)
-        if requester_org and shift_org and requester_org != shift_org:
-            log_event("contact_blocked_cross_org", requester_id=(requester.id if requester else None), requester_org=requester_org, shift_org=shift_org, shift_id=shift_id)
-            await query.answer("Turno non visibile per il tuo reparto.", show_alert=True)
-            return
+    owner_id = user.id
+    date_iso = row[0]
 
-        # Contatto diretto: forniamo username dell'autore 
-        human = datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m/%Y") if date_iso else ""
+    human = iso_to_human(date_iso)
+    await query.edit_message_text(f"✅ Turno rimosso ({human}).")
+    # Tutorial evoluto: completato quando chiude almeno un turno
+    try:
+        if owner_id:
+            maybe_send_tutorial_tip(ctx, owner_id, 4)
+    except Exception:
+        pass
 
-        # owner_username può essere "@handle" oppure nome completo (legacy). Accettiamo solo @handle.
-        handle = None
-        if owner_username and isinstance(owner_username, str) and owner_username.startswith("@") and len(owner_username) > 1:
-            handle = owner_username[1:]
+async def _cb_contact(update: Update, ctx: ContextTypes.DEFAULT_TYPE, kind: str, rest: str):
+    """"Contatta autore": link diretto all'autore del turno."""
+    query = update.callback_query
+    # Tastiere già inviate possono avere campi extra dopo l'id: si ignorano, fa fede solo il DB
+    try:
+        shift_id = int(rest.partition("|")[0], 10)
+    except Exception:
+        await _callback_alert(query, "ID turno non valido.")
+        return
 
-        if not handle:
-            # fallback: prova a leggere username aggiornato dalla tabella users
-            try:
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute("SELECT username FROM users WHERE user_id=?", (owner_id,))
-                r2 = cur.fetchone()
-                conn.close()
-                if r2 and r2[0] and isinstance(r2[0], str) and r2[0].startswith("@") and len(r2[0]) > 1:
-                    handle = r2[0][1:]
-            except Exception:
-                handle = None
+    row = await db_fetchone("SELECT user_id, username, date_iso, org FROM shifts WHERE id=?", (shift_id,))
+    if not row:
+        await _callback_alert(query, "Turno non trovato.")
+        return
+    owner_id, owner_username, date_iso, shift_org = row
+    requester = update.effective_user
+    # blocca contatto cross-reparto
+    # Lettura DB in un thread (e una sola volta: anche il log usa lo stesso valore)
+    requester_org = await asyncio.to_thread(get_approved_org, requester.id) if requester else None
+    log_event("contact_click", requester_id=(requester.id if requester else None), requester_org=requester_org, owner_id=owner_id, shift_org=shift_org, shift_id=shift_id)
+    if requester_org and shift_org and requester_org != shift_org:
+        log_event("contact_blocked_cross_org", requester_id=(requester.id if requester else None), requester_org=requester_org, shift_org=shift_org, shift_id=shift_id)
+        await _callback_alert(query, "Turno non visibile per il tuo reparto.")
+        return
 
-        if not handle:
-            await query.message.reply_text(
-                "⚠️ Non posso fornirti un contatto diretto perché l’autore non ha un username Telegram impostato.\n\n"
-                "Suggerimento: chiedi all’autore di impostare uno username (Impostazioni → Username)."
-            )
-            log_event("contact_no_username", requester_id=(requester.id if requester else None), owner_id=owner_id, shift_id=shift_id)
-            return
+    # Contatto diretto: forniamo username dell'autore 
+    human = iso_to_human(date_iso) if date_iso else ""
+
+    # owner_username può essere "@handle" oppure nome completo (legacy). Accettiamo solo @handle.
+    link = author_link(owner_username)
+
+    if not link:
+        # fallback: prova a leggere username aggiornato dalla tabella users
+        try:
+            r2 = await db_fetchone("SELECT username FROM users WHERE user_id=?", (owner_id,))
+            link = author_link(r2[0]) if r2 else None
+        except Exception:
+            link = None
 
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("📩 Contatta autore", url=f"https://t.me/{handle}")]])
+    if not link:
         await query.message.reply_text(
-            f"👤 Autore turno ({human}): @{handle}",
-            reply_markup=kb
+            "⚠️ Non posso fornirti un contatto diretto perché l’autore non ha un username Telegram impostato.\n\n"
+            "Suggerimento: chiedi all’autore di impostare uno username (Impostazioni → Username)."
         )
-        log_event("contact_direct", requester_id=(requester.id if requester else None), owner_id=owner_id, shift_id=shift_id, owner_handle=handle)
+        log_event("contact_no_username", requester_id=(requester.id if requester else None), owner_id=owner_id, shift_id=shift_id)
         return
 
-    # ---- APPROVE / REJECT / REVOKE ----
-    if parts[0] in ("APPROVE", "REJECT", "REVOKE"):
-        admin = update.effective_user
-        if not admin:
-            return
-        try:
-            target_uid = int(parts[1])
-            org = parts[2]
-        except Exception:
-            await query.edit_message_text("❌ Parametri non validi.")
-            return
+    url_author, label = link
+    kb = _contact_url_kb(url_author)
+    await query.message.reply_text(
+        f"👤 Autore turno ({human}): {label}",
+        reply_markup=kb
+    )
+    log_event("contact_direct", requester_id=(requester.id if requester else None), owner_id=owner_id, shift_id=shift_id, owner_handle=label[1:])
 
-        # verifica admin
-        row = get_user_row(admin.id)
-        if not row:
-            await query.edit_message_text("⛔ Non sei registrato.")
-            return
-        _, admin_org, admin_status = row
-        if admin_status != "approved" or admin_org != org or not is_admin_for_org(admin.id, org):
-            await query.edit_message_text("⛔ Non hai permessi per approvare/rifiutare questo reparto.")
-            return
+async def _cb_user_status(update: Update, ctx: ContextTypes.DEFAULT_TYPE, kind: str, rest: str):
+    """Decisione admin su una richiesta di accesso."""
+    query = update.callback_query
+    admin = update.effective_user
+    if not admin:
+        return
+    try:
+        uid_str, _, org = rest.partition("|")
+        target_uid = int(uid_str, 10)
+        if not org:
+            raise ValueError(org)
+    except Exception:
+        await query.edit_message_text("❌ Parametri non validi.")
+        return
 
-        if parts[0] == "APPROVE":
-            new_status = "approved"
-        elif parts[0] == "REJECT":
-            new_status = "rejected"
-        else:
-            # REVOKE: torna a pending
-            new_status = "pending"
+    # verifica admin (lettura DB in un thread)
+    row = await asyncio.to_thread(get_user_row, admin.id)
+    if not row:
+        await query.edit_message_text("⛔ Non sei registrato.")
+        return
+    _, admin_org, admin_status = row
+    if admin_status != "approved" or admin_org != org or not is_admin_for_org(admin.id, org):
+        await query.edit_message_text("⛔ Non hai permessi per approvare/rifiutare questo reparto.")
+        return
 
-        log_event("user_status_change", admin_id=admin.id, org=org, target_uid=target_uid, action=parts[0], new_status=new_status)
+    if kind == "APPROVE":
+        new_status = "approved"
+    elif kind == "REJECT":
+        new_status = "rejected"
+    else:
+        # REVOKE: torna a pending
+        new_status = "pending"
 
-        # aggiorna user
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET status=? WHERE user_id=? AND org=?", (new_status, target_uid, org))
-        conn.commit()
-        conn.close()
+    log_event("user_status_change", admin_id=admin.id, org=org, target_uid=target_uid, action=kind, new_status=new_status)
 
-        # notifica utente
-        try:
-            if new_status == "approved":
-                await ctx.bot.send_message(
-                    chat_id=target_uid,
-                    text=(
-                        f"✅ Approvato!\nReparto: *{ORG_LABELS.get(org, org)}*\n\n"
-                        "Ora puoi usare il bot.\n\n"
-                        "📌 Funzionamento rapido:\n"
-                        "• Invia screenshot turno → scegli data\n"
-                        "• Cerca turni con *Cerca* o *Date*\n"
-                        "• Gestisci i tuoi con *I miei turni*\n\n"
-                        "Se ti serve di nuovo la guida usa sempre:\n"
-                        "👉 /tutorial"
-                    ),
-                    parse_mode="Markdown",
-                    reply_markup=PRIVATE_KB
-                )
-            elif new_status == "rejected":
-                await ctx.bot.send_message(
-                    chat_id=target_uid,
-                    text="⛔ Richiesta rifiutata. Se pensi sia un errore, contatta l’admin."
-                )
-            else:
-                # pending (revoca)
-                await ctx.bot.send_message(
-                    chat_id=target_uid,
-                    text=("⛔ La tua autorizzazione è stata *revocata* dall'admin del reparto.\n\n"
-                          f"Per riattivarla, invia di nuovo: `/start {org}`"),
-                    parse_mode="Markdown"
-                )
-        except Exception:
-            pass
+    # aggiorna user
+    await db_execute("UPDATE users SET status=? WHERE user_id=? AND org=?", (new_status, target_uid, org))
+
+    # notifica utente
+    try:
+        if new_status == "approved":
+            await safe_send(lambda: ctx.bot.send_message(
+                chat_id=target_uid,
+                text=(
+                    f"✅ Approvato!\nReparto: *{ORG_LABELS.get(org, org)}*\n\n"
+                    "Ora puoi usare il bot.\n\n"
+                    "📌 Funzionamento rapido:\n"
+                    "• Invia screenshot turno → scegli data\n"
+                    "• Cerca turni con *Cerca* o *Date*\n"
+                    "• Gestisci i tuoi con *I miei turni*\n\n"
+                    "Se ti serve di nuovo la guida usa sempre:\n"
+                    "👉 /tutorial"
+                ),
+                parse_mode="Markdown",
+                reply_markup=PRIVATE_KB
+            ), target_uid)
+        elif new_status == "rejected":
+            await safe_send(lambda: ctx.bot.send_message(
+                chat_id=target_uid,
+                text="⛔ Richiesta rifiutata. Se pensi sia un errore, contatta l’admin."
+            ), target_uid)
+        else:
+            # pending (revoca)
+            await safe_send(lambda: ctx.bot.send_message(
+                chat_id=target_uid,
+                text=("⛔ La tua autorizzazione è stata *revocata* dall'admin del reparto.\n\n"
+                      f"Per riattivarla, invia di nuovo: `/start {org}`"),
+                parse_mode="Markdown"
+            ), target_uid)
+    except Exception:
+        pass
+
+    action = kind
+    await query.edit_message_text(f"✅ Operazione completata: {action} → {new_status} (ID {target_uid})")
+
+# kind del callback -> coroutine (update, ctx, kind, rest)
+_CB_HANDLERS = {
+    "NAV": _cb_nav,
+    "SETDATE": _cb_setdate,
+    "SEARCH": _cb_search,
+    "CLOSE": _cb_close,
+    "CONTACT": _cb_contact,
+    "APPROVE": _cb_user_status,
+    "REJECT": _cb_user_status,
+    "REVOKE": _cb_user_status,
+}
 
-        action = parts[0]
-        await query.edit_message_text(f"✅ Operazione completata: {action} → {new_status} (ID {target_uid})")
+async def button_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # Username gate: se manca username, blocca qualsiasi pulsante/callback
+    ok_user = await _gate_username_for_callbacks(update, ctx)
+    if not ok_user:
         return
+    cb_data = update.callback_query.data or ""
+    # Calendario: formato compatto; il formato "KIND|..." resta valido per le tastiere già inviate
+    decoded = decode_calendar_cb(cb_data)
+    if decoded:
+        kind, rest = decoded
+    else:
+        kind, _, rest = cb_data.partition("|")
+    handler = _CB_HANDLERS.get(kind)
+    if handler:
+        await handler(update, ctx, kind, rest)
 
 # -------------------- Text router (private) --------------------
-async def block_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    """Risponde ai testi non riconosciuti in privato, senza interferire con i comandi."""
-    if update.effective_chat.type != ChatType.PRIVATE:
-        return
+# Testo del pulsante (strip + lower) -> comando: un solo lookup, niente regex
+_DM_DISPATCH = {
+    "cerca": search_cmd,
+    "date": dates_cmd,
+    "miei": miei_cmd,
+    "i miei turni": miei_cmd,
+}
 
-    # Se manca username, blocca e spiega come impostarlo
-    if not await require_username(update):
-        raise ApplicationHandlerStop
-    await update.effective_message.reply_text("Usa i pulsanti 👇", reply_markup=PRIVATE_KB)
+# Comandi che il router gestisce anche se arrivano come testo semplice (client/forward)
+_DM_CMD_FALLBACK = {
+    "/tutorial": tutorial_cmd,
+}
 
 async def private_text_router(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.type != ChatType.PRIVATE:
-        return
-
+    # Registrato solo con filters.ChatType.PRIVATE: PTB non lo invoca per i gruppi
     # Username obbligatorio anche per testi normali
     if not await require_username(update):
         raise ApplicationHandlerStop
 
-    text = (update.effective_message.text or "").strip()
+    t = update.effective_message.text
+    if not t:
+        return
 
     # ✅ IMPORTANTISSIMO: non intercettare i comandi.
     # Fallback: se per qualche motivo /tutorial non viene trattato come comando (client/forward), gestiscilo qui.
-    if text.startswith("/"):
-        cmd = text.split()[0].lower()
-        bot_username = (ctx.bot.username or "").lower()
-        if cmd == "/tutorial" or (bot_username and cmd == f"/tutorial@{bot_username}"):
-            await tutorial_cmd(update, ctx)
+    if t[0] == "/":
+        # "/cmd@Bot argomenti" -> ("/cmd", "bot"): due partition, nessuna lista
+        cmd, _, target = t.partition(" ")[0].lower().partition("@")
+        handler = _DM_CMD_FALLBACK.get(cmd)
+        if handler and (not target or target == (ctx.bot.username or "").lower()):
+            await handler(update, ctx)
             raise ApplicationHandlerStop
-        return
-
-    low = text.lower()
 
     # Instrada SOLO i 3 pulsanti (case-insensitive)
-    if low == "cerca":
-        await search_cmd(update, ctx)
-        raise ApplicationHandlerStop
-
-    if low == "date":
-        await dates_cmd(update, ctx)
-        raise ApplicationHandlerStop
-
-    if low in ("miei", "i miei turni"):
-        await miei_cmd(update, ctx)
+    handler = _DM_DISPATCH.get(t.strip().lower())
+    if handler:
+        await handler(update, ctx)
         raise ApplicationHandlerStop
 
-    # Per qualsiasi altro testo: non rispondere qui (ci pensa block_text)
-    return
+    # Qualsiasi altro testo: stesso handler, niente secondo MessageHandler con regex negata
+    await update.effective_message.reply_text("Usa i pulsanti 👇", reply_markup=PRIVATE_KB)
 
 # -------------------- Purge (optional) --------------------
 async def purge_expired_shifts(ctx: ContextTypes.DEFAULT_TYPE):
     """Rimuove dal DB i turni con date passate."""
     try:
         today = datetime.now(TZ).date()
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM shifts
-                       WHERE status='open' AND date(date_iso) < date(?)""", (today.isoformat(),))
-        rows = cur.fetchall()
-        ids = [r[0] for r in rows]
-        if ids:
-            cur.execute(
-                f"DELETE FROM shifts WHERE id IN ({','.join('?'*len(ids))})",
-                ids
-            )
-            conn.commit()
-            print(f"[purge] Rimossi {len(ids)} turni scaduti (fino a {today.isoformat()}).")
-        conn.close()
+        with pool_acquire() as conn:
+            cur = conn.cursor()
+            cur.execute("""SELECT id FROM shifts
+                           WHERE status='open' AND date_ord < ?""", (iso_to_ord(today.isoformat()),))
+            rows = cur.fetchall()
+            ids = [r[0] for r in rows]
+            if ids:
+                cur.execute(
+                    f"DELETE FROM shifts WHERE id IN ({','.join('?'*len(ids))})",
+                    ids
+                )
+                logger.info(f"[purge] Rimossi {len(ids)} turni scaduti (fino a {today.isoformat()}).")
     except Exception as e:
-        print(f"[purge] Errore durante purge: {e}")
+        logger.error(f"[purge] Errore durante purge: {e}")
 
 # -------------------- MAIN --------------------
+async def post_init(app) -> None:
+    """Dopo il getMe iniziale: costruisce subito il pulsante "apri chat privata" (username ora noto)."""
+    _deeplink_kb(app.bot.username or "this_bot")
+
 def main():
     if not TOKEN:
         raise SystemExit("Errore: variabile d'ambiente TELEGRAM_BOT_TOKEN mancante.")
 
     ensure_parent_dir(DB_PATH)
     migrate_sqlite_if_needed(DB_PATH)
-    print(f"[ShiftBot] DB_PATH = {DB_PATH}")
+    logger.info(f"[ShiftBot] DB_PATH = {DB_PATH}")
 
     ensure_db()
+    init_db_pool()
 
     # Defaults (timezone Roma utile per jobqueue / date utils)
-    try:
-        from telegram.ext import Defaults
-        defaults = Defaults(tzinfo=zoneinfo.ZoneInfo("Europe/Rome"))
-        app = ApplicationBuilder().token(TOKEN).defaults(defaults).build()
-    except Exception:
-        app = ApplicationBuilder().token(TOKEN).build()
-
-    # -------------------- Global username gate (ANY /command) --------------------
-    # Se l'utente non ha username, qualunque comando deve rispondere con istruzioni chiare.
-    app.add_handler(
-        MessageHandler(filters.COMMAND, _gate_username_for_commands),
-        group=0
+    # block=False: gli handler lunghi (DB + più chiamate Telegram) non serializzano gli update.
+    # I gate username (group 0) e private_text_router sono registrati con block=True:
+    # usano ApplicationHandlerStop, che PTB ignora negli handler non bloccanti.
+    # Un solo HTTPXRequest condiviso da tutti gli handler: socket/TLS verso api.telegram.org riusati.
+    # getUpdates ha il suo client, così il long polling non occupa slot del pool degli invii.
+    request = HTTPXRequest(
+        connection_pool_size=HTTP_POOL_SIZE,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        connect_timeout=5.0,
+        read_timeout=20.0,
+        http_version=HTTP_VERSION,
     )
-
-    # -------------------- Global username gate (ANY text, non-command) --------------------
-    # Se l'utente non ha username, qualunque messaggio di testo (anche non-comando) deve rispondere con istruzioni chiare.
-    app.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, _gate_username_for_texts),
-        group=0
+    get_updates_request = HTTPXRequest(
+        connection_pool_size=2,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        http_version=HTTP_VERSION,
     )
-
-    # -------------------- Comandi (DM) --------------------
-    app.add_handler(CommandHandler("start", start), group=1)
-    app.add_handler(CommandHandler("help", help_cmd), group=1)          # se ce l'hai
-    app.add_handler(CommandHandler("version", version_cmd), group=1)    # se ce l'hai
-    app.add_handler(CommandHandler("tutorial", tutorial_cmd), group=1)
-    app.add_handler(CommandHandler("commands", commands_cmd), group=1)
-    # Fallback robusto: intercetta anche /tutorial@BotName come testo (alcuni client/forward)
-    app.add_handler(
-        MessageHandler(
-            filters.ChatType.PRIVATE & filters.Regex(r"^/tutorial(?:@\\w+)?(?:\\s|$)"),
-            tutorial_cmd
-        ),
-        group=1
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .post_init(post_init)
     )
-    app.add_handler(CommandHandler("myid", myid_cmd), group=1)
-    app.add_handler(CommandHandler("pending", pending_cmd), group=1)    # se esiste davvero
-    app.add_handler(CommandHandler("approved", approved_cmd), group=1)
-    app.add_handler(CommandHandler("approvati", approved_cmd), group=1)
-    app.add_handler(CommandHandler("approvedpdcfrna", approvedpdcfrna_cmd), group=1)
-    app.add_handler(CommandHandler("approvedpdbfrna", approvedpdbfrna_cmd), group=1)
-    app.add_handler(CommandHandler("admin2507", admin_cmd), group=1)
-    app.add_handler(CommandHandler("logs", logs_cmd), group=1)
-    app.add_handler(CommandHandler("stats", stats_cmd), group=1)
-    app.add_handler(CommandHandler("revoke", revoke_cmd), group=1)
-    app.add_handler(CommandHandler("cerca", search_cmd), group=1)
-    app.add_handler(CommandHandler("date", dates_cmd), group=1)
-    app.add_handler(CommandHandler("miei", miei_cmd), group=1)
-
-    app.add_handler(CommandHandler("backupnow", backupnow_cmd), group=1)
-    app.add_handler(CommandHandler("backupsend", backupsend_cmd), group=1)
+    try:
+        from telegram.ext import Defaults
+        defaults = Defaults(tzinfo=zoneinfo.ZoneInfo("Europe/Rome"), block=False)
+        app = builder.defaults(defaults).build()
+    except Exception:
+        app = builder.build()
+
+    # Tutti gli handler in un'unica add_handlers: PTB riordina i gruppi una sola volta.
+    handlers = {
+        # -------------------- Global username gate --------------------
+        # Se l'utente non ha username, qualunque comando o testo (anche non-comando)
+        # deve rispondere con istruzioni chiare.
+        0: [
+            MessageHandler(filters.COMMAND, _gate_username_for_commands, block=True),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, _gate_username_for_texts, block=True),
+        ],
+        # -------------------- Comandi (DM) --------------------
+        1: [
+            CommandHandler("start", start),
+            CommandHandler("help", help_cmd),
+            CommandHandler("version", version_cmd),
+            # /tutorial@BotName lo gestisce CommandHandler; come testo semplice ci pensa private_text_router
+            CommandHandler("tutorial", tutorial_cmd),
+            CommandHandler("commands", commands_cmd),
+            CommandHandler("myid", myid_cmd),
+            CommandHandler("pending", pending_cmd),
+            CommandHandler("approved", approved_cmd),
+            CommandHandler("approvati", approved_cmd),
+            CommandHandler("approvedpdcfrna", approvedpdcfrna_cmd),
+            CommandHandler("approvedpdbfrna", approvedpdbfrna_cmd),
+            CommandHandler("admin2507", admin_cmd),
+            CommandHandler("logs", logs_cmd),
+            CommandHandler("stats", stats_cmd),
+            CommandHandler("revoke", revoke_cmd),
+            CommandHandler("cerca", search_cmd),
+            CommandHandler("date", dates_cmd),
+            CommandHandler("miei", miei_cmd),
+            CommandHandler("backupnow", backupnow_cmd),
+            CommandHandler("backupsend", backupsend_cmd),
+        ],
+        # -------------------- Upload immagini in privato + callback inline --------------------
+        2: [
+            MessageHandler(filters.ChatType.PRIVATE & (filters.PHOTO | IMG_DOC_FILTER), photo_or_doc_image_handler),
+            CallbackQueryHandler(button_handler),
+        ],
+        # -------------------- Router testo generico in privato --------------------
+        # IMPORTANT: non intercettare i comandi (/myid ecc.)
+        # Pulsanti e testo libero nello stesso handler: una sola valutazione dei filtri per messaggio
+        3: [
+            MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, private_text_router, block=True),
+        ],
+    }
+    app.add_handlers(handlers)
     app.add_error_handler(on_error)
 
-    # -------------------- Upload immagini in privato --------------------
-    img_doc_filter = (
-        filters.Document.IMAGE
-        if hasattr(filters.Document, "IMAGE")
-        else filters.Document.MimeType("image/")
-    )
-    app.add_handler(
-        MessageHandler(filters.ChatType.PRIVATE & (filters.PHOTO | img_doc_filter), photo_or_doc_image_handler),
-        group=2
-    )
-
-    # -------------------- Callback inline --------------------
-    app.add_handler(CallbackQueryHandler(button_handler), group=2)
-
-    # -------------------- Router testo generico in privato --------------------
-    # IMPORTANT: non intercettare i comandi (/myid ecc.)
-    app.add_handler(
-        MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, private_text_router),
-        group=3
-    )
-
-    # Blocca altro testo in DM (escludendo i 3 pulsanti e i comandi)
-    app.add_handler(
-        MessageHandler(
-            filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND & ~filters.Regex("(?i)^(I miei turni|Cerca|Date)$"),
-            block_text
-        ),
-        group=4
-    )
-
     # -------------------- JobQueue purge (se disponibile) --------------------
     jq = getattr(app, "job_queue", None)
     if jq is not None:
@@ -2264,14 +2619,16 @@ def main():
             # Backup DB: una volta dopo l'avvio + ogni giorno alle 03:30 (ora di Roma)
             jq.run_once(backup_job, when=60)
             jq.run_daily(backup_job, time=datetime.strptime("03:30", "%H:%M").time(), days=(0,1,2,3,4,5,6))
+            # Calendari SETDATE abbandonati: pulizia ogni 5 minuti
+            jq.run_repeating(pending_gc_job, interval=300, first=300)
             # Tutorial reminder: (disabilitato)
         except Exception as e:
-            print(f"[ShiftBot] Errore JobQueue: {e}")
+            logger.error(f"[ShiftBot] Errore JobQueue: {e}")
     else:
-        print("[ShiftBot] JobQueue non disponibile (installa python-telegram-bot[job-queue])")
+        logger.warning("[ShiftBot] JobQueue non disponibile (installa python-telegram-bot[job-queue])")
 
-    print("ShiftBot avviato.")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info(f"{VERSION} avviato.")
+    app.run_polling(allowed_updates=Update.ALL_TYPES, poll_interval=0.0, timeout=POLL_TIMEOUT)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file